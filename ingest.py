@@ -2,25 +2,93 @@
 from __future__ import annotations
 
 import argparse
+import asyncio
 import glob
 import hashlib
+import json
 import os
+import re
+import sqlite3
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Any, Iterable, Iterator, List, Sequence, Tuple
+from typing import Any, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
 
 from dotenv import load_dotenv
 from google import genai
+from markdown_it import MarkdownIt
+import blake3
 import chromadb
 
+load_dotenv()
+
+_API_KEY = os.getenv("GEMINI_API_KEY")
+
 DEFAULT_DOCS_GLOB = "docs/**/*.md"
 DEFAULT_CHROMA_PATH = "chroma_db"
 DEFAULT_COLLECTION = "docs"
 DEFAULT_EMBED_MODEL = "gemini-embedding-001"
+DEFAULT_EMBED_CACHE = "chroma_db/embed_cache.sqlite3"
+READ_WORKERS = 16
+BATCH_POLL_SECONDS = 30
+
+_TERMINAL_JOB_STATES = {
+    "JOB_STATE_SUCCEEDED",
+    "JOB_STATE_FAILED",
+    "JOB_STATE_CANCELLED",
+    "JOB_STATE_EXPIRED",
+}
+
+
+class EmbedCache:
+    """Persistent embedding cache backed by SQLite.
+
+    Keys are sha256 digests of the model name and chunk text, so the same
+    chunk embedded with a different model never collides. Vectors are stored
+    as packed float32 bytes.
+    """
+
+    def __init__(self, path: str) -> None:
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS emb (k BLOB PRIMARY KEY, v BLOB)")
+        self._conn.commit()
+
+    @staticmethod
+    def key(model: str, text: str) -> bytes:
+        return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).digest()
+
+    def get(self, key: bytes) -> Optional[np.ndarray]:
+        row = self._conn.execute("SELECT v FROM emb WHERE k = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return np.frombuffer(row[0], dtype=np.float32)
+
+    def put(self, key: bytes, vector: np.ndarray) -> None:
+        self._conn.execute(
+            "INSERT OR REPLACE INTO emb (k, v) VALUES (?, ?)",
+            (key, np.asarray(vector, dtype=np.float32).tobytes()),
+        )
+        self._conn.commit()
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+_WORD_RE = re.compile(r"\S+")
 
 
 def chunk_text(text: str, max_words: int, overlap_words: int) -> Iterator[str]:
     """Yield word-level sliding window chunks.
 
+    Word boundaries are located once up front and each chunk is a single
+    slice of ``text`` between span offsets, so no per-window token list or
+    join is allocated. Used as the fallback splitter for single paragraphs
+    that exceed the chunk budget; structured content goes through
+    :func:`chunk_markdown`.
+
     Parameters
     ----------
     text:
@@ -30,40 +98,169 @@ def chunk_text(text: str, max_words: int, overlap_words: int) -> Iterator[str]:
     overlap_words:
         Word overlap between consecutive chunks to preserve context.
     """
-    tokens = text.split()
-    if not tokens:
+    spans = [match.span() for match in _WORD_RE.finditer(text)]
+    if not spans:
         return
 
     window = max(max_words, 1)
     stride = max(window - max(overlap_words, 0), 1)
 
-    for start in range(0, len(tokens), stride):
-        chunk_tokens = tokens[start : start + window]
-        chunk = " ".join(chunk_tokens).strip()
-        if chunk:
-            yield chunk
+    for start in range(0, len(spans), stride):
+        last = min(start + window, len(spans)) - 1
+        yield text[spans[start][0] : spans[last][1]]
+
+
+def _markdown_sections(text: str) -> Iterator[Tuple[List[str], List[Tuple[str, bool]]]]:
+    """Yield ``(header_lines, blocks)`` for each heading-delimited section.
+
+    ``header_lines`` is the stack of parent headings leading to the section
+    (e.g. ``["# Tutorial", "## Setup"]``). ``blocks`` is the section's
+    top-level markdown blocks as ``(source_text, is_code_fence)`` pairs.
+    """
+    tokens = MarkdownIt().parse(text)
+    lines = text.splitlines()
+
+    stack: List[Tuple[int, str]] = []
+    blocks: List[Tuple[str, bool]] = []
+
+    index = 0
+    while index < len(tokens):
+        token = tokens[index]
+        if token.type == "heading_open" and token.level == 0:
+            if blocks:
+                yield [header for _, header in stack], blocks
+                blocks = []
+            heading_level = int(token.tag[1])
+            title = tokens[index + 1].content
+            while stack and stack[-1][0] >= heading_level:
+                stack.pop()
+            stack.append((heading_level, f"{'#' * heading_level} {title}"))
+            index += 3
+            continue
+
+        if token.level == 0 and token.map is not None:
+            block = "\n".join(lines[token.map[0] : token.map[1]]).strip()
+            if block:
+                blocks.append((block, token.type == "fence"))
+
+        if token.nesting == 1:
+            depth = 1
+            index += 1
+            while index < len(tokens) and depth:
+                depth += tokens[index].nesting
+                index += 1
+            continue
+        index += 1
+
+    if blocks:
+        yield [header for _, header in stack], blocks
+
+
+def chunk_markdown(text: str, max_words: int, overlap_words: int) -> Iterator[str]:
+    """Yield structure-aware chunks that keep heading context and code fences intact.
+
+    Splits at heading boundaries and prepends the parent heading trail to
+    every chunk. Oversized sections are subdivided greedily at paragraph
+    boundaries, carrying up to ``overlap_words`` of trailing paragraphs into
+    the next chunk; code fences are never split. Single paragraphs larger
+    than the budget fall back to the :func:`chunk_text` word window.
+    """
+    for headers, blocks in _markdown_sections(text):
+        prefix = "\n".join(headers)
+        budget = max(max_words - len(prefix.split()), 1)
+
+        def emit(content: str) -> str:
+            return f"{prefix}\n\n{content}" if prefix else content
+
+        group: List[str] = []
+        group_words = 0
+        for block, is_fence in blocks:
+            block_words = len(block.split())
+
+            if block_words > budget and not is_fence:
+                if group:
+                    yield emit("\n\n".join(group))
+                    group, group_words = [], 0
+                for piece in chunk_text(block, budget, overlap_words):
+                    yield emit(piece)
+                continue
+
+            if group and group_words + block_words > budget:
+                yield emit("\n\n".join(group))
+                overlap: List[str] = []
+                overlap_count = 0
+                for previous in reversed(group):
+                    previous_words = len(previous.split())
+                    if overlap_count + previous_words > overlap_words:
+                        break
+                    overlap.insert(0, previous)
+                    overlap_count += previous_words
+                group, group_words = overlap, overlap_count
+
+            group.append(block)
+            group_words += block_words
+
+        if group:
+            yield emit("\n\n".join(group))
+
+
+def quantize_int8(vector: np.ndarray) -> Tuple[np.ndarray, float]:
+    """Quantize a float32 vector to int8 with a per-vector scale.
+
+    Safe only because the collection uses cosine space, which is invariant
+    to the per-vector scale; under L2 the scaling would reorder neighbors.
+    Chroma stores embeddings as float32 regardless of input dtype, so this
+    trades a little precision (256 levels per dimension) for smaller
+    payloads into Chroma, not a smaller index. Queries must be quantized
+    the same way: pair --quantize with RAG_QUANTIZE_INT8 on the API side.
+    """
+    scale = float(np.max(np.abs(vector))) / 127.0
+    if scale == 0.0:
+        scale = 1.0
+    quantized = np.round(vector / scale).astype(np.int8)
+    return quantized, scale
 
 
 def make_chunk_id(source: str, index: int, content: str) -> str:
-    digest = hashlib.sha1(f"{source}:{index}:{content}".encode("utf-8")).hexdigest()
-    return f"{source}:{index}:{digest[:12]}"
+    hasher = blake3.blake3(f"{source}:{index}:".encode("utf-8"))
+    hasher.update(content.encode("utf-8", "ignore"))
+    return f"{source}:{index}:{hasher.hexdigest(length=6)}"
 
 
-def embed_text(client: genai.Client, model: str, text: str) -> Sequence[float]:
-    response = client.models.embed_content(model=model, contents=text)
-    return response.embeddings[0].values
+async def embed_texts(client: genai.Client, model: str, texts: List[str]) -> List[np.ndarray]:
+    """Embed a batch of texts in a single API call."""
+    response = await client.aio.models.embed_content(model=model, contents=texts)
+    return [np.asarray(embedding.values, dtype=np.float32) for embedding in response.embeddings]
 
 
-def flush_batch(
-    collection: Any,
-    batch: List[Tuple[str, str, dict, Sequence[float]]],
-) -> None:
+@dataclass
+class PendingBatch:
+    """Chunks accumulated as four parallel lists, handed to Chroma without copies."""
+
+    ids: List[str] = field(default_factory=list)
+    docs: List[str] = field(default_factory=list)
+    metas: List[dict] = field(default_factory=list)
+    embs: List[np.ndarray] = field(default_factory=list)
+
+    def append(self, chunk_id: str, doc: str, meta: dict, emb: np.ndarray) -> None:
+        self.ids.append(chunk_id)
+        self.docs.append(doc)
+        self.metas.append(meta)
+        self.embs.append(emb)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+
+def flush_batch(collection: Any, batch: PendingBatch) -> None:
     if not batch:
         return
 
-    ids, documents, metadatas, embeddings = zip(*batch)
-    collection.upsert(ids=list(ids), documents=list(documents), metadatas=list(metadatas), embeddings=list(embeddings))
-    batch.clear()
+    collection.upsert(ids=batch.ids, documents=batch.docs, metadatas=batch.metas, embeddings=np.stack(batch.embs))
+    batch.ids.clear()
+    batch.docs.clear()
+    batch.metas.clear()
+    batch.embs.clear()
 
 
 def parse_args() -> argparse.Namespace:
@@ -75,60 +272,293 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("--max-words", type=int, default=320, help="Max words per chunk")
     parser.add_argument("--overlap-words", type=int, default=60, help="Word overlap between chunks")
     parser.add_argument("--batch-size", type=int, default=32, help="Number of chunks to upsert in a batch")
+    parser.add_argument("--concurrency", type=int, default=4, help="Max in-flight embedding batches")
+    parser.add_argument("--embed-cache", default=DEFAULT_EMBED_CACHE, help="Path to the persistent embedding cache")
+    parser.add_argument("--quantize", action="store_true", help="Store int8-quantized embeddings (requires RAG_QUANTIZE_INT8 on the API)")
+    parser.add_argument("--batch-mode", action="store_true", help="Embed via the asynchronous Gemini Batch API (50% cheaper)")
     return parser.parse_args()
 
 
 def resolve_api_key() -> str:
-    load_dotenv()
-    api_key = os.getenv("GEMINI_API_KEY")
-    if not api_key:
+    if not _API_KEY:
         raise RuntimeError("GEMINI_API_KEY is not set. Export it or add it to a .env file.")
-    return api_key
+    return _API_KEY
+
+
+MANIFEST_NAME = ".ingest_manifest.json"
+
+
+def load_manifest(path: Path) -> dict:
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(path: Path, manifest: dict) -> None:
+    """Write the manifest atomically so a crash never leaves a truncated file."""
+    tmp_path = path.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(manifest, indent=2, sort_keys=True), encoding="utf-8")
+    os.replace(tmp_path, path)
+
+
+def _scan_tree(root: str, suffix: str) -> Iterator[Path]:
+    for entry in os.scandir(root):
+        if entry.is_dir(follow_symlinks=False):
+            yield from _scan_tree(entry.path, suffix)
+        elif entry.name.endswith(suffix) and entry.is_file():
+            yield Path(entry.path)
 
 
 def collect_files(pattern: str) -> Iterable[Path]:
+    """Collect files matching ``pattern``.
+
+    Patterns of the form ``<root>/**/*<suffix>`` (the default) walk the tree
+    with :func:`os.scandir`, which reuses the cached DirEntry stat instead of
+    issuing a stat plus fnmatch per candidate. Anything else falls back to
+    the recursive glob.
+    """
+    root, sep, suffix = pattern.partition("/**/*")
+    if sep and "*" not in root and "*" not in suffix and os.path.isdir(root):
+        yield from _scan_tree(root, suffix)
+        return
+
     for path in glob.glob(pattern, recursive=True):
         file_path = Path(path)
         if file_path.is_file():
             yield file_path
 
 
-def main() -> None:
+async def embed_batch(
+    client: genai.Client,
+    model: str,
+    pending: List[Tuple[str, str, dict]],
+    semaphore: asyncio.Semaphore,
+    queue: "asyncio.Queue[Tuple[str, str, dict, np.ndarray]]",
+    cache: EmbedCache,
+    quantize: bool,
+) -> None:
+    """Embed one batch of pending chunks and enqueue the results for the writer.
+
+    Cached chunks skip the API call entirely; only misses are embedded.
+    The cache always holds full-precision vectors; quantization is applied
+    on the way out so the flag can be toggled without re-embedding.
+    """
+
+    async def enqueue(chunk_id: str, chunk: str, metadata: dict, embedding: np.ndarray) -> None:
+        if quantize:
+            embedding, scale = quantize_int8(embedding)
+            metadata["embed_scale"] = scale
+        await queue.put((chunk_id, chunk, metadata, embedding))
+
+    misses: List[Tuple[str, str, dict, bytes]] = []
+    for chunk_id, chunk, metadata in pending:
+        key = EmbedCache.key(model, chunk)
+        cached = cache.get(key)
+        if cached is not None:
+            await enqueue(chunk_id, chunk, metadata, cached)
+        else:
+            misses.append((chunk_id, chunk, metadata, key))
+
+    if not misses:
+        return
+
+    async with semaphore:
+        embeddings = await embed_texts(client, model, [chunk for _, chunk, _, _ in misses])
+    for (chunk_id, chunk, metadata, key), embedding in zip(misses, embeddings):
+        cache.put(key, embedding)
+        await enqueue(chunk_id, chunk, metadata, embedding)
+
+
+async def write_results(
+    collection: Any,
+    queue: "asyncio.Queue[Tuple[str, str, dict, np.ndarray]]",
+    batch_size: int,
+) -> None:
+    """Drain the result queue, upserting into Chroma in batch-sized blocks."""
+    batch = PendingBatch()
+    while True:
+        record = await queue.get()
+        if record is None:
+            break
+        batch.append(*record)
+        if len(batch) >= batch_size:
+            flush_batch(collection, batch)
+    flush_batch(collection, batch)
+
+
+async def ingest_batch_mode(
+    client: genai.Client,
+    collection: Any,
+    args: argparse.Namespace,
+    records: List[Tuple[str, str, dict]],
+    cache: EmbedCache,
+) -> None:
+    """Embed all uncached chunks through the Gemini Batch API.
+
+    Builds one JSONL of embed requests keyed by chunk ID, submits a single
+    batch job (50% cheaper than real-time calls), polls until it finishes,
+    then upserts the results. Cache hits bypass the job entirely.
+    """
+    batch = PendingBatch()
+
+    def stage(chunk_id: str, chunk: str, metadata: dict, embedding: np.ndarray) -> None:
+        if args.quantize:
+            embedding, scale = quantize_int8(embedding)
+            metadata["embed_scale"] = scale
+        batch.append(chunk_id, chunk, metadata, embedding)
+        if len(batch) >= args.batch_size:
+            flush_batch(collection, batch)
+
+    misses: dict = {}
+    for chunk_id, chunk, metadata in records:
+        key = EmbedCache.key(args.embed_model, chunk)
+        cached = cache.get(key)
+        if cached is not None:
+            stage(chunk_id, chunk, metadata, cached)
+        else:
+            misses[chunk_id] = (chunk, metadata, key)
+
+    if misses:
+        # Embedding batch jobs use EmbedContentRequest lines (singular
+        # "content"), not the generateContent shape.
+        with tempfile.NamedTemporaryFile("w", suffix=".jsonl", delete=False) as handle:
+            for chunk_id, (chunk, _, _) in misses.items():
+                request = {"key": chunk_id, "request": {"content": {"parts": [{"text": chunk}]}}}
+                handle.write(json.dumps(request) + "\n")
+            jsonl_path = handle.name
+
+        try:
+            uploaded = client.files.upload(file=jsonl_path, config={"mime_type": "jsonl"})
+        finally:
+            os.unlink(jsonl_path)
+
+        job = client.batches.create_embeddings(
+            model=args.embed_model, src=uploaded.name, config={"display_name": "ingest"}
+        )
+        while job.state.name not in _TERMINAL_JOB_STATES:
+            await asyncio.sleep(BATCH_POLL_SECONDS)
+            job = client.batches.get(name=job.name)
+        if job.state.name != "JOB_STATE_SUCCEEDED":
+            raise RuntimeError(f"Batch embedding job '{job.name}' ended in state {job.state.name}.")
+
+        results = client.files.download(file=job.dest.file_name).decode("utf-8")
+        for line in results.splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            chunk_id = record["key"]
+            payload = record["response"]
+            values = payload["embeddings"][0]["values"] if "embeddings" in payload else payload["embedding"]["values"]
+            embedding = np.asarray(values, dtype=np.float32)
+            chunk, metadata, key = misses[chunk_id]
+            cache.put(key, embedding)
+            stage(chunk_id, chunk, metadata, embedding)
+
+    flush_batch(collection, batch)
+
+
+async def amain() -> None:
     args = parse_args()
 
     api_key = resolve_api_key()
     client = genai.Client(api_key=api_key)
 
     chroma_client = chromadb.PersistentClient(path=args.chroma_path)
-    collection = chroma_client.get_or_create_collection(args.collection)
+    # Request cosine space (what makes --quantize's per-vector scaling
+    # safe), but note Chroma ignores metadata for pre-existing collections,
+    # so verify the effective space before quantizing.
+    collection = chroma_client.get_or_create_collection(
+        args.collection, metadata={"hnsw:space": "cosine"}
+    )
+    if args.quantize:
+        space = (collection.metadata or {}).get("hnsw:space", "l2")
+        if space != "cosine":
+            raise RuntimeError(
+                f"--quantize requires a cosine-space collection, but '{args.collection}' uses "
+                f"{space}; per-vector scaling would reorder L2 neighbors. Delete the collection "
+                "and re-ingest to rebuild it with cosine space."
+            )
 
     files = sorted(collect_files(args.docs_glob))
     if not files:
         print(f"No files matched pattern '{args.docs_glob}'. Nothing to ingest.")
         return
 
+    manifest_path = Path(args.chroma_path) / MANIFEST_NAME
+    manifest = load_manifest(manifest_path)
+
     total_chunks = 0
-    batch: List[Tuple[str, str, dict, Sequence[float]]] = []
+    skipped_files = 0
+    pending: List[Tuple[str, str, dict]] = []
+    batches: List[List[Tuple[str, str, dict]]] = []
 
+    candidates: List[Tuple[Path, int]] = []
     for path in files:
-        text = path.read_text(encoding="utf-8", errors="ignore")
-        for index, chunk in enumerate(chunk_text(text, args.max_words, args.overlap_words)):
+        mtime_ns = path.stat().st_mtime_ns
+        entry = manifest.get(str(path))
+        if entry is not None and entry[0] == mtime_ns:
+            skipped_files += 1
+            continue
+        candidates.append((path, mtime_ns))
+
+    # Overlap disk reads across files; each read is pure I/O so threads help
+    # even under the GIL.
+    with ThreadPoolExecutor(max_workers=READ_WORKERS) as pool:
+        contents = list(pool.map(lambda item: item[0].read_bytes(), candidates))
+
+    for (path, mtime_ns), data in zip(candidates, contents):
+        entry = manifest.get(str(path))
+        digest = hashlib.sha1(data).hexdigest()
+        if entry is not None and entry[1] == digest:
+            manifest[str(path)] = [mtime_ns, digest]
+            skipped_files += 1
+            continue
+        manifest[str(path)] = [mtime_ns, digest]
+
+        text = data.decode("utf-8", errors="ignore")
+        for index, chunk in enumerate(chunk_markdown(text, args.max_words, args.overlap_words)):
             chunk_id = make_chunk_id(str(path), index, chunk)
-            embedding = embed_text(client, args.embed_model, chunk)
             metadata = {"source": str(path), "chunk_index": index}
-            batch.append((chunk_id, chunk, metadata, embedding))
+            pending.append((chunk_id, chunk, metadata))
             total_chunks += 1
 
-            if len(batch) >= args.batch_size:
-                flush_batch(collection, batch)
-
-    flush_batch(collection, batch)
+            if len(pending) >= args.batch_size:
+                batches.append(pending)
+                pending = []
+
+    if pending:
+        batches.append(pending)
+
+    cache = EmbedCache(args.embed_cache)
+    try:
+        if args.batch_mode:
+            records = [record for pending in batches for record in pending]
+            await ingest_batch_mode(client, collection, args, records, cache)
+        else:
+            semaphore = asyncio.Semaphore(max(args.concurrency, 1))
+            queue: "asyncio.Queue[Tuple[str, str, dict, np.ndarray]]" = asyncio.Queue()
+            writer = asyncio.create_task(write_results(collection, queue, args.batch_size))
+            await asyncio.gather(
+                *(embed_batch(client, args.embed_model, batch, semaphore, queue, cache, args.quantize) for batch in batches)
+            )
+            await queue.put(None)
+            await writer
+    finally:
+        cache.close()
+
+    save_manifest(manifest_path, manifest)
 
     print(
         f"Ingested {total_chunks} chunk{'s' if total_chunks != 1 else ''} "
-        f"into collection '{args.collection}' at '{args.chroma_path}'."
+        f"into collection '{args.collection}' at '{args.chroma_path}' "
+        f"({skipped_files} unchanged file{'s' if skipped_files != 1 else ''} skipped)."
     )
 
 
+def main() -> None:
+    asyncio.run(amain())
+
+
 if __name__ == "__main__":
     main()
@@ -1,17 +1,29 @@
 """FastAPI application powering the docs chat experience."""
 from __future__ import annotations
 
+import asyncio
+import json
 import os
+from collections import OrderedDict
 from functools import lru_cache
-from typing import Any, Dict, List, Sequence
+from typing import Any, AsyncIterator, Dict, List, Sequence
 
+import httpx
+import numpy as np
+import uvloop
+
+from cachetools import TTLCache
 from dotenv import load_dotenv
 from fastapi import FastAPI, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
 from google import genai
+from google.genai import types as genai_types
 import chromadb
 
+uvloop.install()
 load_dotenv()
 
 CHROMA_PATH = os.getenv("CHROMA_PATH", "chroma_db")
@@ -19,7 +31,18 @@ COLLECTION_NAME = os.getenv("CHROMA_COLLECTION", "docs")
 EMBED_MODEL = os.getenv("GEMINI_EMBED_MODEL", "gemini-embedding-001")
 GENERATE_MODEL = os.getenv("GEMINI_CHAT_MODEL", "gemini-2.5-flash")
 RAG_TOP_K = int(os.getenv("RAG_TOP_K", "5"))
+# Must match how the collection was ingested: enable if and only if
+# ingest.py ran with --quantize, otherwise int8-scaled queries are compared
+# against full-precision vectors (or vice versa) and retrieval degrades.
+QUANTIZE_INT8 = os.getenv("RAG_QUANTIZE_INT8", "").lower() in {"1", "true", "yes"}
+EMBED_CACHE_SIZE = int(os.getenv("RAG_EMBED_CACHE_SIZE", "1024"))
+ANSWER_CACHE_SIZE = int(os.getenv("RAG_ANSWER_CACHE_SIZE", "512"))
+ANSWER_CACHE_TTL = float(os.getenv("RAG_ANSWER_CACHE_TTL", "600"))
 MAX_CONTEXT_SECTIONS = int(os.getenv("RAG_MAX_CONTEXT", "5"))
+# Retrieve enough chunks for both the prompt context and the sources list,
+# and only the fields we read — no distances or embeddings.
+RETRIEVE_K = max(MAX_CONTEXT_SECTIONS, RAG_TOP_K)
+RETRIEVE_INCLUDE = ["documents", "metadatas"]
 
 ALLOWED_ORIGINS = [origin.strip() for origin in os.getenv("RAG_ALLOWED_ORIGINS", "*").split(",") if origin.strip()]
 ALLOWED_HEADERS = ["*"]
@@ -40,19 +63,79 @@ def get_genai_client() -> genai.Client:
     api_key = os.getenv("GEMINI_API_KEY")
     if not api_key:
         raise RuntimeError("GEMINI_API_KEY is not configured. Set it in the environment or a .env file.")
-    return genai.Client(api_key=api_key)
+    # One multiplexed HTTP/2 connection pool for all Gemini calls, instead
+    # of paying TCP+TLS setup per request. Timeout is in milliseconds.
+    http_options = genai_types.HttpOptions(
+        timeout=30_000,
+        async_client_args={
+            "http2": True,
+            "limits": httpx.Limits(max_keepalive_connections=32, max_connections=64),
+        },
+    )
+    return genai.Client(api_key=api_key, http_options=http_options)
 
 
 @lru_cache(maxsize=1)
 def get_chroma_collection() -> Any:
     client = chromadb.PersistentClient(path=CHROMA_PATH)
-    return client.get_or_create_collection(COLLECTION_NAME)
-
+    # Request cosine space to match ingest.py, but Chroma ignores metadata
+    # for pre-existing collections, so check the effective space before
+    # quantizing queries against it; see quantize_int8.
+    collection = client.get_or_create_collection(COLLECTION_NAME, metadata={"hnsw:space": "cosine"})
+    if QUANTIZE_INT8:
+        space = (collection.metadata or {}).get("hnsw:space", "l2")
+        if space != "cosine":
+            raise RuntimeError(
+                f"RAG_QUANTIZE_INT8 requires a cosine-space collection, but '{COLLECTION_NAME}' "
+                f"uses {space}; per-vector scaling would reorder L2 neighbors. Re-ingest into a "
+                "fresh collection to rebuild it with cosine space."
+            )
+    return collection
+
+
+def quantize_int8(vector: np.ndarray) -> np.ndarray:
+    """Apply the same int8 quantization ingest.py uses for stored vectors.
+
+    Safe only because the collection uses cosine space, which is invariant
+    to the per-vector scale — that is also why the scale itself is not
+    needed at query time. Only meaningful when the index was built with
+    ingest.py --quantize; see the QUANTIZE_INT8 note above.
+    """
+    scale = float(np.max(np.abs(vector))) / 127.0
+    if scale == 0.0:
+        scale = 1.0
+    return np.round(vector / scale).astype(np.int8)
+
+
+# Query-embedding LRU: repeat questions skip the provider round-trip.
+# lru_cache cannot wrap a coroutine, so this is a small OrderedDict LRU.
+_embed_cache: "OrderedDict[str, np.ndarray]" = OrderedDict()
+
+
+async def embed_query(text: str) -> Sequence[float]:
+    key = text.strip().lower()
+    cached = _embed_cache.get(key)
+    if cached is not None:
+        _embed_cache.move_to_end(key)
+        return cached
 
-def embed_query(text: str) -> Sequence[float]:
     client = get_genai_client()
-    response = client.models.embed_content(model=EMBED_MODEL, contents=text)
-    return response.embeddings[0].values
+    response = await client.aio.models.embed_content(model=EMBED_MODEL, contents=text)
+    vector = np.asarray(response.embeddings[0].values, dtype=np.float32)
+    if QUANTIZE_INT8:
+        vector = quantize_int8(vector)
+
+    _embed_cache[key] = vector
+    if len(_embed_cache) > EMBED_CACHE_SIZE:
+        _embed_cache.popitem(last=False)
+    return vector
+
+
+# Full-answer cache: identical questions over the same retrieved chunks skip
+# the LLM call entirely. The TTL bounds how long stale answers outlive a
+# re-ingest.
+_answer_cache: TTLCache = TTLCache(maxsize=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL)
+_answer_cache_lock = asyncio.Lock()
 
 
 def format_context(documents: Sequence[str], metadatas: Sequence[Dict[str, Any]]) -> str:
@@ -90,32 +173,49 @@ def build_prompt(context: str, question: str) -> str:
     )
 
 
-def generate_answer(prompt: str) -> str:
+async def generate_answer(prompt: str) -> str:
     client = get_genai_client()
-    response = client.models.generate_content(model=GENERATE_MODEL, contents=prompt)
-    text = getattr(response, "text", None)
-    if text:
-        return text.strip()
-    if hasattr(response, "candidates"):
-        for candidate in response.candidates or []:
-            parts = getattr(candidate, "content", None)
-            if not parts:
-                continue
-            for part in getattr(parts, "parts", []):
-                text_part = getattr(part, "text", None)
-                if text_part:
-                    return text_part.strip()
+    response = await client.aio.models.generate_content(model=GENERATE_MODEL, contents=prompt)
+    if response.text:
+        return response.text.strip()
+    for candidate in response.candidates or ():
+        if candidate.content is None:
+            continue
+        for part in candidate.content.parts or ():
+            if part.text:
+                return part.text.strip()
     return "I couldn't generate a response."
 
 
+class FastCORSMiddleware(CORSMiddleware):
+    """CORSMiddleware with an O(1) origin check.
+
+    Short-circuits the wildcard case and replaces the list scan with a set
+    lookup; the chat widget sends a preflight per POST, so this runs on
+    every request.
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self._origin_set = set(self.allow_origins)
+
+    def is_allowed_origin(self, origin: str) -> bool:
+        if self.allow_all_origins:
+            return True
+        if origin in self._origin_set:
+            return True
+        return super().is_allowed_origin(origin)
+
+
 app = FastAPI(title="Docs RAG API", version="0.1.0")
 
 app.add_middleware(
-    CORSMiddleware,
+    FastCORSMiddleware,
     allow_origins=ALLOWED_ORIGINS,
     allow_credentials=False,
     allow_methods=ALLOWED_METHODS,
     allow_headers=ALLOWED_HEADERS,
+    max_age=86400,
 )
 
 
@@ -124,25 +224,36 @@ async def health() -> Dict[str, str]:
     return {"status": "ok"}
 
 
-@app.post("/chat", response_model=ChatOut)
-async def chat(payload: ChatIn) -> ChatOut:
-    question = payload.query.strip()
-    if not question:
-        raise HTTPException(status_code=400, detail="Query must not be empty.")
-
+async def retrieve(question: str) -> Dict[str, Any]:
+    """Embed the question and fetch the top matching chunks from Chroma."""
     try:
-        query_embedding = embed_query(question)
+        query_embedding = await embed_query(question)
     except Exception as exc:
         raise HTTPException(status_code=500, detail=f"Failed to embed query: {exc}") from exc
 
     collection = get_chroma_collection()
     try:
-        results = collection.query(query_embeddings=[query_embedding], n_results=RAG_TOP_K)
+        return await run_in_threadpool(
+            collection.query,
+            query_embeddings=[query_embedding],
+            n_results=RETRIEVE_K,
+            include=RETRIEVE_INCLUDE,
+        )
     except Exception as exc:
         raise HTTPException(status_code=500, detail=f"Vector store query failed: {exc}") from exc
 
+
+@app.post("/chat", response_model=ChatOut)
+async def chat(payload: ChatIn) -> ChatOut:
+    question = payload.query.strip()
+    if not question:
+        raise HTTPException(status_code=400, detail="Query must not be empty.")
+
+    results = await retrieve(question)
+
     documents = results.get("documents", [[]])[0]
     metadatas = results.get("metadatas", [[]])[0]
+    doc_ids = results.get("ids", [[]])[0]
 
     if not documents:
         return ChatOut(
@@ -150,16 +261,90 @@ async def chat(payload: ChatIn) -> ChatOut:
             sources=[],
         )
 
+    cache_key = (question.strip().lower(), tuple(doc_ids))
+    async with _answer_cache_lock:
+        cached = _answer_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
     context = format_context(documents[:MAX_CONTEXT_SECTIONS], metadatas[:MAX_CONTEXT_SECTIONS])
     prompt = build_prompt(context, question)
 
     try:
-        answer = generate_answer(prompt)
+        answer = await generate_answer(prompt)
     except Exception as exc:
         raise HTTPException(status_code=500, detail=f"Content generation failed: {exc}") from exc
 
     sources = collect_sources(metadatas)
-    return ChatOut(answer=answer, sources=sources)
+    result = ChatOut(answer=answer, sources=sources)
+    async with _answer_cache_lock:
+        _answer_cache[cache_key] = result
+    return result
+
+
+def sse_event(payload: Dict[str, Any]) -> str:
+    return f"data: {json.dumps(payload)}\n\n"
+
+
+@app.post("/chat/stream")
+async def chat_stream(payload: ChatIn) -> StreamingResponse:
+    """Streaming variant of /chat: answer tokens arrive as SSE deltas.
+
+    Each event is a JSON object with a ``delta`` key; the final event
+    carries the deduplicated ``sources`` list. The embedding call starts
+    before the response is returned and the Chroma collection is warmed
+    while it is in flight, so the stream opens without waiting for
+    retrieval to finish.
+    """
+    question = payload.query.strip()
+    if not question:
+        raise HTTPException(status_code=400, detail="Query must not be empty.")
+
+    embed_task = asyncio.create_task(embed_query(question))
+    collection = get_chroma_collection()
+
+    async def event_stream() -> AsyncIterator[str]:
+        try:
+            query_embedding = await embed_task
+        except Exception as exc:
+            yield sse_event({"error": f"Failed to embed query: {exc}"})
+            return
+
+        try:
+            results = await run_in_threadpool(
+                collection.query,
+                query_embeddings=[query_embedding],
+                n_results=RETRIEVE_K,
+                include=RETRIEVE_INCLUDE,
+            )
+        except Exception as exc:
+            yield sse_event({"error": f"Vector store query failed: {exc}"})
+            return
+
+        documents = results.get("documents", [[]])[0]
+        metadatas = results.get("metadatas", [[]])[0]
+
+        if not documents:
+            yield sse_event({"delta": "I couldn't find anything relevant in the indexed documentation."})
+            yield sse_event({"sources": []})
+            return
+
+        context = format_context(documents[:MAX_CONTEXT_SECTIONS], metadatas[:MAX_CONTEXT_SECTIONS])
+        prompt = build_prompt(context, question)
+
+        client = get_genai_client()
+        try:
+            stream = await client.aio.models.generate_content_stream(model=GENERATE_MODEL, contents=prompt)
+            async for chunk in stream:
+                if chunk.text:
+                    yield sse_event({"delta": chunk.text})
+        except Exception as exc:
+            yield sse_event({"error": f"Content generation failed: {exc}"})
+            return
+
+        yield sse_event({"sources": collect_sources(metadatas)})
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
 
 
 @app.get("/")